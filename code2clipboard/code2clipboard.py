@@ -3,17 +3,47 @@
 import os
 import sys
 import argparse
+import atexit
+import json
 import pyperclip
-import tiktoken
 import re
+import shutil
+import subprocess
+import tiktoken
+from array import array
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
 from pathspec import PathSpec
 from pathspec.patterns.gitwildmatch import GitWildMatchPattern
-from fnmatch import fnmatch
+from fnmatch import translate
+
+try:
+    import liburing
+except ImportError:
+    liburing = None
 
 DIM = "\033[2m"
 RED = "\033[31m"
 RESET = "\033[0m"
 
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "code2clipboard")
+TOKEN_CACHE_FILE = os.path.join(CACHE_DIR, "tokens.json")
+
+BINARY_PEEK_SIZE = 8192
+BINARY_CONTROL_BYTES = bytes(range(9)) + bytes(range(14, 32))
+NO_TOKENS = -1
+TOKENIZE_MAX_THREADS = 8
+CLIPBOARD_PIPE_MIN_SIZE = 1 << 20
+MERGE_CHUNK_SIZE = 4 << 20
+
+TOKEN_LABELS = [str(i) for i in range(1000)]
+SIZE_LABELS = ["1kb"] + [f"{i}kb" for i in range(1, 2048)]
+
+URING_MIN_FILES = 16
+URING_BATCH_SIZE = 256
+
+READ_ERROR = object()
+
 def load_gitignore_specs(root_dir, extra_excludes=None):
     patterns = []
     gitignore = os.path.join(root_dir, '.gitignore')
@@ -24,7 +54,66 @@ def load_gitignore_specs(root_dir, extra_excludes=None):
         patterns.extend(extra_excludes)
     return PathSpec.from_lines(GitWildMatchPattern, patterns)
 
+def save_token_cache(cache, name, loaded):
+    if cache[name] == loaded:
+        return
+    tmp_path = f"{TOKEN_CACHE_FILE}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, TOKEN_CACHE_FILE)
+    except OSError as e:
+        print(f"Could not save token cache: {e}", file=sys.stderr)
+
+def load_token_cache(enc):
+    try:
+        with open(TOKEN_CACHE_FILE, "r", encoding="utf-8") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    if not isinstance(cache, dict):
+        cache = {}
+    if not isinstance(cache.get(enc.name), dict):
+        cache[enc.name] = {}
+    entries = cache[enc.name]
+    atexit.register(save_token_cache, cache, enc.name, dict(entries))
+    return entries
+
+def is_cache_hit(cached, st):
+    if not isinstance(cached, list) or len(cached) != 3 or cached[:2] != [st.st_mtime_ns, st.st_size]:
+        return False
+    tokens = cached[2]
+    return tokens is None or (type(tokens) is int and 0 <= tokens < 2 ** 31)
+
+def is_suffix_pattern(pat):
+    return pat.startswith("*.") and not any(c in pat[1:] for c in "*?[")
+
+def compile_include_patterns(include):
+    if not include:
+        return None
+    fold_case = os.path.normcase("A") == "a"
+    suffixes = tuple(os.path.normcase(pat[1:]) for pat in include if is_suffix_pattern(pat))
+
+    def has_suffix(name):
+        return (os.path.normcase(name) if fold_case else name).endswith(suffixes)
+
+    others = [pat for pat in include if not is_suffix_pattern(pat)]
+    if not others:
+        return has_suffix
+    pattern = re.compile("|".join(translate(pat) for pat in others), re.IGNORECASE if fold_case else 0)
+    if not suffixes:
+        return pattern.match
+    return lambda name: has_suffix(name) or pattern.match(name) is not None
+
+def match_excluded(exclude_spec, rel_paths):
+    if not exclude_spec or not rel_paths:
+        return set()
+    return set(exclude_spec.match_files(rel_paths))
+
 def human_tokens(num):
+    if 0 <= num < len(TOKEN_LABELS):
+        return TOKEN_LABELS[num]
     if num < 1000:
         return str(num)
     elif num < 10000:
@@ -35,126 +124,325 @@ def human_tokens(num):
 def human_size(num_bytes):
     if num_bytes <= 0:
         return "0kb"
-    kb = max(1, num_bytes // 1024)
+    kb = num_bytes >> 10
+    if kb < len(SIZE_LABELS):
+        return SIZE_LABELS[kb]
     return f"{kb}kb"
 
-def get_file_tokens(path, enc):
+def is_binary(head):
+    if b"\x00" in head:
+        return True
+    control = len(head) - len(head.translate(None, BINARY_CONTROL_BYTES))
+    return control > len(head) // 3
+
+def read_file_bytes(path):
+    with open(path, "rb") as f:
+        head = f.read(BINARY_PEEK_SIZE)
+        if is_binary(head):
+            return None
+        return head + f.read()
+
+def decode_text(data):
+    text = data.decode("utf-8", errors="replace")
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text
+
+def decode_merged(merged):
+    if b"\r" in merged:
+        merged = merged.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
     try:
-        with open(path, "r", encoding="utf-8", errors="replace") as f:
-            return len(enc.encode(f.read()))
-    except:
-        return 0
+        return merged, merged.decode("utf-8")
+    except UnicodeDecodeError:
+        return None, merged.decode("utf-8", errors="replace")
+
+def read_files(reader, *iterables):
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        return list(executor.map(reader, *iterables))
+
+@dataclass
+class Files:
+    names: list = field(default_factory=list)
+    sizes: array = field(default_factory=lambda: array("q"))
+    tokens: array = field(default_factory=lambda: array("i"))
+    skipped: bytearray = field(default_factory=bytearray)
 
-def build_tree_structure(directory, enc, exclude_spec, include, add_hidden, max_file_size):
+    def __len__(self):
+        return len(self.names)
+
+    def append(self, name, size, skipped):
+        self.names.append(name)
+        self.sizes.append(size)
+        self.tokens.append(NO_TOKENS)
+        self.skipped.append(skipped)
+        return len(self.names) - 1
+
+    def set_tokens(self, i, tokens):
+        if tokens is None:
+            tokens = NO_TOKENS if self.skipped[i] else 0
+        self.tokens[i] = tokens
+
+def new_dir_structure(directory, parent=None):
     name = os.path.basename(directory) or directory
-    structure = {"name": name, "path": directory, "files": [], "dirs": [], "tokens": 0, "size": 0}
-    try:
-        items = sorted(os.listdir(directory))
-    except OSError as e:
-        print(f"Cannot list directory {directory}: {e}", file=sys.stderr)
-        return structure
+    return {"name": name, "path": directory, "files": Files(), "dirs": [], "tokens": 0, "size": 0, "parent": parent}
 
-    for item in items:
-        if item.startswith('.') and not add_hidden:
+def add_to_totals(structure, size=0, tokens=0):
+    while structure is not None:
+        structure["size"] += size
+        structure["tokens"] += tokens
+        structure = structure["parent"]
+
+def set_file_tokens(structure, i, tokens):
+    files = structure["files"]
+    files.set_tokens(i, tokens)
+    if not files.skipped[i]:
+        add_to_totals(structure, tokens=files.tokens[i])
+
+def walk_tree_structure(directory, exclude_spec, include, add_hidden, max_file_size, pending):
+    root = new_dir_structure(directory)
+    stack = [root]
+    while stack:
+        structure = stack.pop()
+        path = structure["path"]
+        try:
+            with os.scandir(path) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError as e:
+            print(f"Cannot list directory {path}: {e}", file=sys.stderr)
             continue
-        full_path = os.path.join(directory, item)
-        rel_path = os.path.relpath(full_path, directory)
 
-        if os.path.isdir(full_path):
-            if exclude_spec and exclude_spec.match_file(item + "/"):
-                continue
-            sub = build_tree_structure(full_path, enc, exclude_spec, include, add_hidden, max_file_size)
-            structure["dirs"].append(sub)
-            structure["tokens"] += sub["tokens"]
-            structure["size"] += sub["size"]
-        else:
-            if exclude_spec and exclude_spec.match_file(rel_path):
+        candidates = []
+        for entry in entries:
+            item = entry.name
+            if item.startswith('.') and not add_hidden:
                 continue
-            if include and not any(fnmatch(item, pat) for pat in include):
+            if entry.is_dir(follow_symlinks=False):
+                candidates.append((entry, os.path.relpath(entry.path, directory) + "/"))
+            elif entry.is_file():
+                candidates.append((entry, os.path.relpath(entry.path, directory)))
+        excluded = match_excluded(exclude_spec, [rel_path for _, rel_path in candidates])
+
+        files = structure["files"]
+        for entry, rel_path in candidates:
+            if rel_path in excluded:
                 continue
-            fsize = os.path.getsize(full_path)
-            structure["size"] += fsize
-            if fsize > max_file_size:
-                ftokens = get_file_tokens(full_path, enc) if fsize < 1_000_000 else None
-                skipped = True
+            item = entry.name
+            full_path = entry.path
+
+            if rel_path.endswith("/"):
+                structure["dirs"].append(new_dir_structure(full_path, structure))
             else:
-                ftokens = get_file_tokens(full_path, enc)
-                skipped = False
-                structure["tokens"] += ftokens
-            structure["files"].append({"name": item, "size": fsize, "tokens": ftokens, "skipped": skipped})
+                if include and not include(item):
+                    continue
+                st = entry.stat()
+                fsize = st.st_size
+                skipped = fsize > max_file_size
+                i = files.append(item, fsize, skipped)
+                add_to_totals(structure, size=fsize)
+                if not skipped or fsize < 1_000_000:
+                    pending.append((structure, i, full_path, st))
+        stack.extend(reversed(structure["dirs"]))
+    return root
+
+def count_chunk_tokens(enc, chunk):
+    return [len(enc.encode_ordinary(text)) for text in chunk]
+
+def count_tokens(enc, texts, threads=None):
+    if not texts:
+        return []
+    threads = threads or min(os.cpu_count() or 1, TOKENIZE_MAX_THREADS)
+    threads = max(1, min(threads, len(texts)))
+    chunks = [texts[i::threads] for i in range(threads)]
+    counts = [0] * len(texts)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for i, chunk_counts in enumerate(executor.map(count_chunk_tokens, [enc] * threads, chunks)):
+            counts[i::threads] = chunk_counts
+    return counts
+
+def chunk_reads(reads, chunk_size):
+    chunk, size = [], 0
+    for read in reads:
+        chunk.append(read)
+        size += read[3].st_size
+        if size >= chunk_size:
+            yield chunk
+            chunk, size = [], 0
+    if chunk:
+        yield chunk
+
+def build_tree_and_merge(directory, enc, exclude_spec, include, add_hidden, max_file_size, token_cache=None, merge=True,
+                         tokenize_threads=None):
+    pending = []
+    structure = walk_tree_structure(directory, exclude_spec, include, add_hidden, max_file_size, pending)
+    if token_cache is None:
+        token_cache = {}
+    reads = []
+    for node, i, path, st in pending:
+        cached = token_cache.get(path)
+        if is_cache_hit(cached, st):
+            set_file_tokens(node, i, cached[2])
+            if merge and not node["files"].skipped[i]:
+                reads.append((node, i, path, st, False))
+        else:
+            reads.append((node, i, path, st, True))
+    root_prefix = os.path.join(directory, "")
+    seen = {path for _, _, path, _ in pending}
+    for path in [path for path in token_cache if path.startswith(root_prefix) and path not in seen]:
+        del token_cache[path]
+    merged = bytearray()
+    for chunk in chunk_reads(reads, MERGE_CHUNK_SIZE):
+        contents = read_merge_files([read[2] for read in chunk], [read[3].st_size for read in chunk])
+        failed = {j for j, content in enumerate(contents) if content is READ_ERROR}
+        contents = [None if content is READ_ERROR else content for content in contents]
+        texts = [decode_text(content) for read, content in zip(chunk, contents)
+                 if read[4] and content is not None]
+        counts = iter(count_tokens(enc, texts, tokenize_threads))
+        del texts
+        for j, (node, i, path, st, needs_tokens) in enumerate(chunk):
+            content, contents[j] = contents[j], None
+            if needs_tokens:
+                tokens = None if content is None else next(counts)
+                if j not in failed:
+                    token_cache[path] = [st.st_mtime_ns, st.st_size, tokens]
+                set_file_tokens(node, i, tokens)
+            if merge and not node["files"].skipped[i] and content is not None:
+                rel_path = os.path.relpath(path, directory)
+                header = f"==============================\nFile: {rel_path}\n==============================\n"
+                merged += header.encode("utf-8")
+                merged += content
+                merged += b"\n\n"
+    return structure, merged
+
+def build_tree_structure(directory, enc, exclude_spec, include, add_hidden, max_file_size, token_cache=None,
+                         tokenize_threads=None):
+    structure, _ = build_tree_and_merge(directory, enc, exclude_spec, include, add_hidden, max_file_size,
+                                        token_cache, merge=False, tokenize_threads=tokenize_threads)
     return structure
 
-def format_tree_for_console(s, prefix="", is_last=True, max_file_size=20480):
+def format_tree_for_console(s, prefix="", is_last=True, skip_note=""):
     lines = []
-    branch = "└──" if is_last else "├──"
-    lines.append(f"{prefix}{branch} {s['name']}/"
-                 f"{DIM} - {human_size(s['size'])} ~{human_tokens(s['tokens'])} tokens{RESET}")
-    next_prefix = prefix + ("    " if is_last else "│   ")
-    for i, f in enumerate(s["files"]):
-        file_branch = "└──" if (i == len(s["files"]) - 1 and not s["dirs"]) else "├──"
-        if f["skipped"]:
-            note = f"[skipped because > {human_size(max_file_size)}]"
-            line = f"{next_prefix}{file_branch} {RED}{f['name']} - {human_size(f['size'])} {note}"
-            if f["tokens"] is not None:
-                line += f" ~{human_tokens(f['tokens'])} tokens"
-            line += RESET
-        else:
-            line = (f"{next_prefix}{file_branch} {f['name']}"
-                    f"{DIM} - {human_size(f['size'])} ~{human_tokens(f['tokens'])} tokens{RESET}")
-        lines.append(line)
-    for j, d in enumerate(s["dirs"]):
-        sub_last = (j == len(s["dirs"]) - 1)
-        lines.extend(format_tree_for_console(d, prefix=next_prefix, is_last=sub_last, max_file_size=max_file_size))
+    stack = [(s, prefix, is_last)]
+    while stack:
+        s, prefix, is_last = stack.pop()
+        branch = "└──" if is_last else "├──"
+        lines.append(f"{prefix}{branch} {s['name']}/"
+                     f"{DIM} - {human_size(s['size'])} ~{human_tokens(s['tokens'])} tokens{RESET}")
+        next_prefix = prefix + ("    " if is_last else "│   ")
+        files = s["files"]
+        dirs = s["dirs"]
+        for i, (name, size, tokens, skipped) in enumerate(zip(files.names, files.sizes, files.tokens, files.skipped)):
+            file_branch = "└──" if (i == len(files) - 1 and not dirs) else "├──"
+            if skipped:
+                line = f"{next_prefix}{file_branch} {RED}{name} - {human_size(size)} {skip_note}"
+                if tokens != NO_TOKENS:
+                    line += f" ~{human_tokens(tokens)} tokens"
+                line += RESET
+            else:
+                line = (f"{next_prefix}{file_branch} {name}"
+                        f"{DIM} - {human_size(size)} ~{human_tokens(tokens)} tokens{RESET}")
+            lines.append(line)
+        stack.extend((d, next_prefix, j == len(dirs) - 1) for j, d in reversed(list(enumerate(dirs))))
     return lines
 
-def format_tree_for_clipboard(s, prefix="", is_last=True, max_file_size=20480):
+def format_tree_for_clipboard(s, prefix="", is_last=True, skip_note=""):
     lines = []
-    branch = "└──" if is_last else "├──"
-    lines.append(f"{prefix}{branch} {s['name']}/ - {human_size(s['size'])}")
-    next_prefix = prefix + ("    " if is_last else "│   ")
-    for i, f in enumerate(s["files"]):
-        file_branch = "└──" if (i == len(s["files"]) - 1 and not s["dirs"]) else "├──"
-        if f["skipped"]:
-            note = f"[skipped because > {human_size(max_file_size)}]"
-            lines.append(f"{next_prefix}{file_branch} {f['name']} - {human_size(f['size'])} {note}")
-        else:
-            lines.append(f"{next_prefix}{file_branch} {f['name']} - {human_size(f['size'])}")
-    for j, d in enumerate(s["dirs"]):
-        sub_last = (j == len(s["dirs"]) - 1)
-        lines.extend(format_tree_for_clipboard(d, prefix=next_prefix, is_last=sub_last, max_file_size=max_file_size))
+    stack = [(s, prefix, is_last)]
+    while stack:
+        s, prefix, is_last = stack.pop()
+        branch = "└──" if is_last else "├──"
+        lines.append(f"{prefix}{branch} {s['name']}/ - {human_size(s['size'])}")
+        next_prefix = prefix + ("    " if is_last else "│   ")
+        files = s["files"]
+        dirs = s["dirs"]
+        for i, (name, size, skipped) in enumerate(zip(files.names, files.sizes, files.skipped)):
+            file_branch = "└──" if (i == len(files) - 1 and not dirs) else "├──"
+            if skipped:
+                lines.append(f"{next_prefix}{file_branch} {name} - {human_size(size)} {skip_note}")
+            else:
+                lines.append(f"{next_prefix}{file_branch} {name} - {human_size(size)}")
+        stack.extend((d, next_prefix, j == len(dirs) - 1) for j, d in reversed(list(enumerate(dirs))))
     return lines
 
-def gather_files_for_merge(directory, exclude_spec, include, add_hidden, max_file_size):
-    valid = []
-    for root, dirs, files in os.walk(directory):
-        if not add_hidden:
-            dirs[:] = [d for d in dirs if not d.startswith('.')]
-        for fname in files:
-            if not add_hidden and fname.startswith('.'):
-                continue
-            full_path = os.path.join(root, fname)
-            rel_path = os.path.relpath(full_path, directory)
-            if exclude_spec and exclude_spec.match_file(rel_path):
-                continue
-            if os.path.getsize(full_path) > max_file_size:
-                continue
-            if include and not any(fnmatch(fname, pat) for pat in include):
-                continue
-            valid.append(full_path)
-    return valid
-
-def get_merged_content(directory, enc, exclude_spec, include, add_hidden, max_file_size):
-    valid_files = gather_files_for_merge(directory, exclude_spec, include, add_hidden, max_file_size)
-    merged = []
-    for path in valid_files:
-        rel_path = os.path.relpath(path, directory)
-        header = f"==============================\nFile: {rel_path}\n==============================\n"
+def read_merge_file(path):
+    try:
+        return read_file_bytes(path)
+    except Exception as e:
+        print(f"Error reading {path}: {e}", file=sys.stderr)
+        return READ_ERROR
+
+def open_for_read(path):
+    try:
+        return os.open(path, os.O_RDONLY)
+    except OSError as e:
+        print(f"Error reading {path}: {e}", file=sys.stderr)
+        return None
+
+def uring_read(ring, cqe, reads):
+    results = [0] * len(reads)
+    for k, (fd, buf) in enumerate(reads):
+        if not buf:
+            continue
+        sqe = liburing.io_uring_get_sqe(ring)
+        liburing.io_uring_prep_read(sqe, fd, buf, 0)
+        liburing.io_uring_sqe_set_data64(sqe, k)
+    for _ in range(liburing.io_uring_submit(ring)):
+        liburing.io_uring_wait_cqe(ring, cqe)
+        entry = cqe[0]
+        try:
+            results[entry.user_data] = entry.res
+        except OSError as e:
+            results[entry.user_data] = e
+        liburing.io_uring_cqe_seen(ring, entry)
+    return results
+
+def read_uring_batch(ring, cqe, paths, sizes, opened, results):
+    heads = [(i, fd, bytearray(min(sizes[i], BINARY_PEEK_SIZE))) for i, fd in opened]
+    full = []
+    for (i, fd, head), res in zip(heads, uring_read(ring, cqe, [(fd, head) for _, fd, head in heads])):
+        if isinstance(res, OSError):
+            print(f"Error reading {paths[i]}: {res}", file=sys.stderr)
+            continue
+        del head[res:]
+        if is_binary(head):
+            results[i] = None
+        elif res == BINARY_PEEK_SIZE and sizes[i] > BINARY_PEEK_SIZE:
+            full.append((i, fd, bytearray(sizes[i])))
+        else:
+            results[i] = head
+    for (i, fd, buf), res in zip(full, uring_read(ring, cqe, [(fd, buf) for _, fd, buf in full])):
+        if isinstance(res, OSError):
+            print(f"Error reading {paths[i]}: {res}", file=sys.stderr)
+            continue
+        del buf[res:]
+        results[i] = buf
+
+def read_files_uring(paths, sizes):
+    results = [READ_ERROR] * len(paths)
+    ring = liburing.Ring()
+    cqe = liburing.Cqe()
+    liburing.io_uring_queue_init(URING_BATCH_SIZE, ring)
+    try:
+        for start in range(0, len(paths), URING_BATCH_SIZE):
+            indices = range(start, min(start + URING_BATCH_SIZE, len(paths)))
+            fds = read_files(open_for_read, [paths[i] for i in indices])
+            try:
+                opened = [(i, fd) for i, fd in zip(indices, fds) if fd is not None]
+                read_uring_batch(ring, cqe, paths, sizes, opened, results)
+            finally:
+                for fd in fds:
+                    if fd is not None:
+                        os.close(fd)
+    finally:
+        liburing.io_uring_queue_exit(ring)
+    return results
+
+def read_merge_files(paths, sizes):
+    if liburing is not None and len(paths) > URING_MIN_FILES:
         try:
-            with open(path, "r", encoding="utf-8", errors="replace") as f:
-                merged.append(header + f.read() + "\n\n")
-        except Exception as e:
-            print(f"Error reading {path}: {e}", file=sys.stderr)
-    return "".join(merged)
+            return read_files_uring(paths, sizes)
+        except OSError:
+            pass
+    return read_files(read_merge_file, paths)
 
 def parse_merged_text(merged_text):
     pattern = r"==============================\nFile: (.*?)\n==============================\n"
@@ -191,8 +479,7 @@ def partial_display_merged(merged_text, max_files=3, max_lines=10):
     else:
         print(f"All {total} files shown (partially). The full content is in the clipboard.")
 
-def get_tree_texts(directory, enc, exclude_spec, include, add_hidden, max_file_size):
-    structure = build_tree_structure(directory, enc, exclude_spec, include, add_hidden, max_file_size)
+def get_tree_texts(directory, structure, max_file_size):
     top = {
         "name": os.path.basename(directory.rstrip("/")) or directory,
         "size": structure["size"],
@@ -200,12 +487,43 @@ def get_tree_texts(directory, enc, exclude_spec, include, add_hidden, max_file_s
         "files": structure["files"],
         "dirs": structure["dirs"]
     }
-    console = "\n".join(format_tree_for_console(top, max_file_size=max_file_size))
-    cb = "\n".join(format_tree_for_clipboard(top, max_file_size=max_file_size))
+    skip_note = f"[skipped because > {human_size(max_file_size)}]"
+    console = "\n".join(format_tree_for_console(top, skip_note=skip_note))
+    cb = "\n".join(format_tree_for_clipboard(top, skip_note=skip_note))
     return console, cb
 
-def do_tree(directory, enc, exclude_spec, include, add_hidden, max_file_size):
-    console, cb = get_tree_texts(directory, enc, exclude_spec, include, add_hidden, max_file_size)
+def clipboard_command():
+    if sys.platform == "darwin":
+        return ["pbcopy"]
+    if sys.platform.startswith("linux"):
+        if shutil.which("xclip"):
+            return ["xclip", "-selection", "clipboard"]
+        if shutil.which("xsel"):
+            return ["xsel", "--clipboard", "--input"]
+    return None
+
+def clipboard_pipe_command(cb_tree, merged):
+    if merged is None or len(cb_tree) + len(merged) < CLIPBOARD_PIPE_MIN_SIZE:
+        return None
+    return clipboard_command()
+
+def copy_merged_to_clipboard(cb_tree, merged, merged_text, command):
+    if command:
+        try:
+            subprocess.run(command, input=cb_tree.encode("utf-8") + b"\n\n" + merged, check=True)
+            return
+        except (OSError, subprocess.CalledProcessError):
+            pass
+    pyperclip.copy(cb_tree + "\n\n" + merged_text)
+
+def print_total_tokens(structure):
+    print(f"Estimated total tokens: {human_tokens(structure['tokens'])}")
+
+def do_tree(directory, enc, exclude_spec, include, add_hidden, max_file_size, token_cache=None,
+            tokenize_threads=None):
+    structure = build_tree_structure(directory, enc, exclude_spec, include, add_hidden, max_file_size, token_cache,
+                                     tokenize_threads)
+    console, cb = get_tree_texts(directory, structure, max_file_size)
     print(console)
     try:
         pyperclip.copy(cb)
@@ -213,16 +531,25 @@ def do_tree(directory, enc, exclude_spec, include, add_hidden, max_file_size):
     except Exception as e:
         print(f"Could not copy to clipboard: {e}")
 
-def do_tokens(directory, enc, exclude_spec, include, add_hidden, max_file_size):
-    structure = build_tree_structure(directory, enc, exclude_spec, include, add_hidden, max_file_size)
-    print(f"Estimated total tokens: {human_tokens(structure['tokens'])}")
+def do_tokens(directory, enc, exclude_spec, include, add_hidden, max_file_size, token_cache=None,
+              tokenize_threads=None):
+    structure = build_tree_structure(directory, enc, exclude_spec, include, add_hidden, max_file_size, token_cache,
+                                     tokenize_threads)
+    print_total_tokens(structure)
 
-def do_merge_and_tree(directory, enc, exclude_spec, include, add_hidden, max_file_size):
-    merged_text = get_merged_content(directory, enc, exclude_spec, include, add_hidden, max_file_size)
-    console_tree, cb_tree = get_tree_texts(directory, enc, exclude_spec, include, add_hidden, max_file_size)
-    final_clipboard = cb_tree + "\n\n" + merged_text
+def do_merge_and_tree(directory, enc, exclude_spec, include, add_hidden, max_file_size, token_cache=None,
+                      show_tokens=False, tokenize_threads=None):
+    structure, merged = build_tree_and_merge(directory, enc, exclude_spec, include, add_hidden, max_file_size,
+                                             token_cache, tokenize_threads=tokenize_threads)
+    if show_tokens:
+        print_total_tokens(structure)
+    merged, merged_text = decode_merged(merged)
+    console_tree, cb_tree = get_tree_texts(directory, structure, max_file_size)
+    command = clipboard_pipe_command(cb_tree, merged)
+    if command is None:
+        merged = None
     try:
-        pyperclip.copy(final_clipboard)
+        copy_merged_to_clipboard(cb_tree, merged, merged_text, command)
         print("(Tree + All file contents copied to clipboard.)\n")
     except Exception as e:
         print(f"Could not copy to clipboard: {e}\n")
@@ -230,6 +557,12 @@ def do_merge_and_tree(directory, enc, exclude_spec, include, add_hidden, max_fil
     print("\nHere is a **partial preview**. The **entire** content is already in your clipboard.\n")
     partial_display_merged(merged_text, max_files=3, max_lines=10)
 
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
 def main():
     parser = argparse.ArgumentParser(
         description="Code2Clipboard: Scan codebase, tokenize content, generate LLM-ready prompts."
@@ -241,20 +574,30 @@ def main():
     parser.add_argument("--exclude", nargs="*", help="Extra exclude patterns.")
     parser.add_argument("--add-hidden", action="store_true", help="Include hidden files/folders.")
     parser.add_argument("--max-file-size", type=int, default=20480, help="Max file size in bytes (default 20KB).")
+    parser.add_argument("--tokenize-threads", type=positive_int, help="Tokenizer worker threads (default min(CPUs, 8)).")
     args = parser.parse_args()
 
     directory = os.path.abspath(args.directory)
     exclude_spec = load_gitignore_specs(directory, args.exclude)
-    enc = tiktoken.encoding_for_model("gpt-4o")
+    include = compile_include_patterns(args.include)
+    os.environ.setdefault("TIKTOKEN_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "tiktoken"))
+    try:
+        enc = tiktoken.encoding_for_model("gpt-4o")
+    except Exception as e:
+        print(f"Could not load the gpt-4o tokenizer: {e}", file=sys.stderr)
+        sys.exit(1)
+    enc.encode_ordinary("warmup")
+    token_cache = load_token_cache(enc)
 
     if args.tree and not args.tokens:
-        do_tree(directory, enc, exclude_spec, args.include, args.add_hidden, args.max_file_size)
+        do_tree(directory, enc, exclude_spec, include, args.add_hidden, args.max_file_size, token_cache,
+                args.tokenize_threads)
     elif args.tokens and not args.tree:
-        do_tokens(directory, enc, exclude_spec, args.include, args.add_hidden, args.max_file_size)
+        do_tokens(directory, enc, exclude_spec, include, args.add_hidden, args.max_file_size, token_cache,
+                  args.tokenize_threads)
     else:
-        if args.tokens:
-            do_tokens(directory, enc, exclude_spec, args.include, args.add_hidden, args.max_file_size)
-        do_merge_and_tree(directory, enc, exclude_spec, args.include, args.add_hidden, args.max_file_size)
+        do_merge_and_tree(directory, enc, exclude_spec, include, args.add_hidden, args.max_file_size, token_cache,
+                          show_tokens=args.tokens, tokenize_threads=args.tokenize_threads)
 
 if __name__ == "__main__":
     main()